@@ -10,6 +10,12 @@ import os
 import sqlite3
 import multiprocessing
 import warnings
+from dataclasses import dataclass
+from numba import guvectorize, float64
+
+# Register adapters for other non-supported types if needed
+sqlite3.register_adapter(np.int64, lambda val: int(val))
+sqlite3.register_adapter(np.int32, lambda val: int(val))
 
 class SQLitePeakMatchingManager:
     """Class to manage peak matching data in SQLite database."""
@@ -24,14 +30,25 @@ class SQLitePeakMatchingManager:
         self.db_filename = db_filename
         self.db_folder_path = os.path.dirname(db_filename)
         self.conn = sqlite3.connect(db_filename)
-        self.peak_table = pd.read_sql_query(f"SELECT * FROM {peak_table_name};", self.conn)
-        self.peak_table['prot_rep'] = self.peak_table['protein_id'] + '_' + self.peak_table['replicate']
-        self.peak_table = self.peak_table.drop(columns='sample')
+        self.conn.execute('PRAGMA journal_mode=WAL;')
+        self.conn.execute('PRAGMA synchronous=NORMAL;')
+        self.conn.execute('PRAGMA temp_store=MEMORY;')
+        self.conn.execute('PRAGMA cache_size=-262144;')
+
+        #read the peak table in chunks, selecting all columns except the sample column
+        peak_columns = [column_info[1] for column_info in self.conn.execute(f"PRAGMA table_info({peak_table_name});") if column_info[1] != 'sample']
+        select_columns = ', '.join(f'"{c}"' for c in peak_columns)
+        query = f"SELECT {select_columns} FROM {peak_table_name};"
+        self.peak_table = pd.concat(pd.read_sql_query(query, self.conn, chunksize=200_000), ignore_index=True, copy=False)
+        self.peak_table['prot_rep'] = self.peak_table['protein_id'].astype(str).str.cat(self.peak_table['replicate'].astype(str), sep='_')
         self.prot_rep = self.peak_table['prot_rep'].unique()
-        self.prot_rep_peak_df_list = [group for _, group in self.peak_table.groupby('prot_rep')]
         self.group_cols = ['prot_rep', 'protein_id', 'genes', 'replicate']
         self.conditions = self.peak_table['condition'].unique()
         self.ptms = self.peak_table['ptm'].unique()
+
+        #encode the low-cardinality string keys as categoricals (integer codes for grouping/hashing)
+        for col in ['prot_rep', 'protein_id', 'genes', 'cluster', 'replicate', 'condition', 'ptm']:
+            self.peak_table[col] = self.peak_table[col].astype('category')
     
     def save_to_SQL(self, df, table_name):
         """Save a DataFrame to a table in the SQLite database.
@@ -40,24 +57,18 @@ class SQLitePeakMatchingManager:
             df (pd.DataFrame): The DataFrame to save.
             table_name (str): The name of the table to save the DataFrame to.
         """
-        #convert lists to string
-        def convert_lists_to_string(cell):
-            if isinstance(cell, list):
-                return '|'.join(map(str, cell))
-            elif pd.isna(cell):
-                return cell
-            else:
-                return str(cell)
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=FutureWarning)
-            df = df.applymap(convert_lists_to_string) #ignore this warning for now
-
-        # Register adapters for other non-supported types if needed
-        sqlite3.register_adapter(np.int64, lambda val: int(val))
-        sqlite3.register_adapter(np.int32, lambda val: int(val))
-
-        # Save to SQLite
-        df.to_sql(table_name, self.conn, index=False, if_exists='replace')
+        #convert lists to string - only the columns containing lists are converted
+        df = df.copy(deep=False)
+        for col in df.columns:
+            sample = df[col].dropna().head(1)
+            if len(sample) > 0 and isinstance(sample.iloc[0], list):
+                df[col] = df[col].map(lambda cell: '|'.join(map(str, cell)) if isinstance(cell, list) else cell)
+
+        # Save to SQLite - multi-row inserts, limited by the maximum number of variables per statement
+        #(Connection.getlimit requires python>=3.11, otherwise assume the SQLite default of 999 variables)
+        max_variables = self.conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) if hasattr(self.conn, 'getlimit') else 999
+        chunksize = max(1, min(10_000, max_variables // max(1, len(df.columns))))
+        df.to_sql(table_name, self.conn, index=False, if_exists='replace', method='multi', chunksize=chunksize)
         self.conn.commit()
 
     def close_connection(self):
@@ -65,51 +76,110 @@ class SQLitePeakMatchingManager:
         self.conn.close()
 
 
+###Peak arrays used by the matching functions###
+@dataclass
+class PeakSOA:
+    """Structure of arrays holding the peak attributes used by the matching functions (one array per column).
+    
+    Attributes:
+        apex (np.ndarray): The peak apexes.
+        left (np.ndarray): The peak left bounds.
+        right (np.ndarray): The peak right bounds.
+        peak_id (np.ndarray): The peak ids.
+        cluster (np.ndarray): The peak clusters.
+        group_key (np.ndarray): The key of the group each peak belongs to.
+    """
+    apex: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    peak_id: np.ndarray
+    cluster: np.ndarray
+    group_key: np.ndarray
+
+    @classmethod
+    def from_df(cls, df, group_key):
+        """Create the PeakSOA object from the columns of a peak DataFrame.
+        
+        Args:
+            df (pd.DataFrame): The DataFrame containing the peak data.
+            group_key (np.ndarray): The key of the group each peak belongs to.
+        
+        Returns:
+            PeakSOA: The peak arrays of the DataFrame.
+        """
+        return cls(apex=df['peak_apex'].to_numpy(dtype=float),
+                   left=df['peak_left'].to_numpy(dtype=float),
+                   right=df['peak_right'].to_numpy(dtype=float),
+                   peak_id=df['peak_id'].to_numpy(copy=False),
+                   cluster=df['cluster'].to_numpy(copy=False),
+                   group_key=np.asarray(group_key))
+
+    def take(self, index):
+        """Select the peaks at the given positions.
+        
+        Args:
+            index (np.ndarray): The positions (or boolean mask) of the peaks to select.
+        
+        Returns:
+            PeakSOA: The peak arrays of the selected peaks.
+        """
+        return PeakSOA(self.apex[index], self.left[index], self.right[index], self.peak_id[index], self.cluster[index], self.group_key[index])
+
+    def group_indices(self, sort=False):
+        """Get the positions of the peaks in each group.
+        
+        Args:
+            sort (bool): Whether to sort the groups by their key (Default: False).
+        
+        Returns:
+            dict: The group keys mapped to the positions of their peaks.
+        """
+        return pd.Series(self.group_key).groupby(self.group_key, sort=sort, dropna=False).indices
+
+
 ###PTM peak matching functions - performed separately in this iteration###
-def ptm_eval(cond_ptm_merge_df, cond_ptm='_ptm', apex_diff_cutoff=1):
-    """Evaluate the peak matching between the global and ptm peaks.
+def ptm_eval(global_peaks, ptm_peaks, apex_diff_cutoff=1):
+    """Evaluate the peak matching between the global and ptm peaks of a single group.
      This version tests whether: 
      (1)the peak difference is within the distance cutoff, and 
      (2) whether the peaks left/right bounds overlap.
+    Every global peak is tested against every ptm peak by broadcasting the global arrays along the rows and the ptm arrays along the columns.
     
     Args:
-        cond_ptm_merge_df (pd.DataFrame): The DataFrame containing the global and ptm peaks.
-        cond_ptm (str): The suffix for the ptm columns (Default: '_ptm').
+        global_peaks (PeakSOA): The global peaks.
+        ptm_peaks (PeakSOA): The ptm peaks.
         apex_diff_cutoff (int): The maximum difference in peak apexes allowed for a match (Default: 1).
     
     Returns:
-        pd.Series: A series of 1s and 0s indicating whether the peak matches the ptm peak.
+        np.ndarray: A (global peaks x ptm peaks) int8 matrix of 1s and 0s indicating whether the global peak matches the ptm peak.
     """
     #apex condition
-    peak_apex_diff = abs(cond_ptm_merge_df['peak_apex'] - cond_ptm_merge_df[f'peak_apex{cond_ptm}'])
+    peak_apex_diff = np.abs(global_peaks.apex[:, None] - ptm_peaks.apex[None, :])
     apex_condition = peak_apex_diff < apex_diff_cutoff
 
     #overlap condition
-    overlap_condition = ~((cond_ptm_merge_df['peak_right'] < cond_ptm_merge_df[f'peak_left{cond_ptm}']) | (cond_ptm_merge_df['peak_left'] > cond_ptm_merge_df[f'peak_right{cond_ptm}']))
+    overlap_condition = ~((global_peaks.right[:, None] < ptm_peaks.left[None, :]) | (global_peaks.left[:, None] > ptm_peaks.right[None, :]))
 
     #pass evaluation
-    pass_condition = (apex_condition * overlap_condition).astype(int)
-    return pass_condition
-    
-def replace_ptm_col_values(row, ptm, col):
-    """Replace the values in the ptm column with the values in the col column.
+    return (apex_condition & overlap_condition).astype(np.int8)
 
+def join_ptm_matches(match_global_index, match_values, n_global_peaks):
+    """Join the values of the matched ptm peaks into a ';' separated string for each global peak.
+    
     Args:
-        row (pd.Series): The row of the DataFrame.
-        ptm (str): The name of the ptm column.
-        col (str): The name of the column to replace the ptm column values with.
-
+        match_global_index (list): The arrays of global peak positions of the matches.
+        match_values (list): The arrays of ptm peak values (e.g., peak ids) of the matches.
+        n_global_peaks (int): The number of global peaks.
+    
     Returns:
-        str: The value of the col column if the ptm column is 1, otherwise None.
+        np.ndarray: The joined values for each global peak ('' if the global peak has no matches).
     """
-    if row[ptm] == 1:
-        return str(row[col])
-    else:
-        return None
+    matches = pd.Series(np.concatenate(match_values or [[]]), index=np.concatenate(match_global_index or [[]]).astype(int), dtype=object)
+    return matches.groupby(level=0, sort=False).agg(';'.join).reindex(range(n_global_peaks), fill_value='').to_numpy()
 
 def ptm_matching(input_df):
     """Match the global peaks to the ptm peaks and summarize the results.
-    In this version, all ptm peaks are tested for matching with all global peaks.
+    In this version, all ptm peaks are tested for matching with all global peaks of the same protein replicate/condition.
     This function allows for multiple ptm peaks to match a single global peak and vice versa.
     Additionally, each matched peak is defined by the global peak attributes (allows for rapid ptm matching).
     
@@ -119,10 +189,6 @@ def ptm_matching(input_df):
     Returns:
         pd.DataFrame: The DataFrame containing the matched peaks (global and ptm) and their attributes.
     """
-    #create a skeleton dataframe to ensure that all protein replicates/conditions are present in the final dataframe
-    skeleton_df = pd.DataFrame(columns = input_df.columns)
-    skeleton_df[['prot_rep', 'protein_id', 'genes', 'condition', 'replicate']] = input_df[['prot_rep', 'protein_id', 'genes', 'condition', 'replicate']].drop_duplicates().reset_index(drop=True)
-
     #split the global and ptm peaks into separate dataframes
     global_df = input_df[input_df['ptm'] == 'global'].reset_index(drop=True)
     global_df['global'] = 1 
@@ -132,105 +198,120 @@ def ptm_matching(input_df):
     
     ptm_df = input_df[input_df['ptm'] != 'global'].reset_index(drop=True)
 
-    #make sure that the all ptm columns are present for each protein replicate.
-    for p in ptms:
-        if p not in ptm_df['ptm'].unique():
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore", category=FutureWarning)
-                ptm_df = pd.concat([ptm_df, skeleton_df.copy().assign(ptm=p)], ignore_index=True) #ignore this warning for now
-
-    #iterate through each ptm df to merge with the global df
-    ptm_df_list = [group for _, group in ptm_df.groupby('ptm')]
-    for i in range(len(ptm_df_list)):
-        #prep ptm dataframe
-        ptm_df_i = ptm_df_list[i].reset_index(drop=True)
-        ptm = ptm_df_i['ptm'].unique()[0]
-
-        #merge global and ptm dataframes
-        group_cols = ['prot_rep', 'protein_id', 'genes', 'condition', 'replicate']
-        global_ptm_merge_i = global_df.merge(ptm_df_i, on=group_cols, how='left', suffixes=('', '_ptm'))
-
-        #get valid ptm matches - run evaluation function
-        global_ptm_merge_i[ptm] = ptm_eval(global_ptm_merge_i, apex_diff_cutoff=threshold)
-
-        #Summarize ptm matches - fill result df with values
-        global_ptm_merge_i_summary = global_ptm_merge_i[group_cols+[ptm,'peak_apex','cluster_ptm', 'peak_id_ptm']]
-        global_ptm_merge_i_summary = global_ptm_merge_i_summary.assign(cluster_ptm = global_ptm_merge_i_summary.apply(replace_ptm_col_values, args=(ptm,'cluster_ptm',), axis=1))
-        global_ptm_merge_i_summary = global_ptm_merge_i_summary.assign(peak_id_ptm = global_ptm_merge_i_summary.apply(replace_ptm_col_values, args=(ptm,'peak_id_ptm',), axis=1))
-        global_ptm_merge_i_summary = global_ptm_merge_i_summary.groupby(group_cols+['peak_apex'], as_index=False).agg({ptm:'sum', 'cluster_ptm':lambda x: ';'.join(filter(None, x)), 'peak_id_ptm':lambda x: ';'.join(filter(None, x))})
-
-        #merge ptm counts and clusters
-        final_global_df = global_df.merge(global_ptm_merge_i_summary, on=group_cols+['peak_apex'], how='left')
-
-        #concatenated string of cluster_ptm to the cluster column
-        final_global_df['cluster'] = final_global_df.apply(lambda x: ';'.join(filter(None, [x['cluster'], x['cluster_ptm']])), axis=1).astype(str)
+    #assign shared group codes to the global and ptm peaks (protein replicate/condition)
+    group_cols = ['prot_rep', 'protein_id', 'genes', 'condition', 'replicate']
+    group_codes = pd.concat([global_df[group_cols], ptm_df[group_cols]], ignore_index=True).groupby(group_cols, sort=False, dropna=False, observed=True).ngroup().to_numpy()
+    global_peaks = PeakSOA.from_df(global_df, group_codes[:len(global_df)])
+    ptm_peaks = PeakSOA.from_df(ptm_df, group_codes[len(global_df):])
+    global_groups = global_peaks.group_indices()
+    global_group_peaks = {code: global_peaks.take(global_index) for code, global_index in global_groups.items()}
+    ptm_positions = ptm_df.groupby('ptm', sort=False, observed=True).indices
+
+    #iterate through each ptm to match with the global peaks
+    match_global_index, match_cluster_ptm = [], []
+    for ptm in ptms:
+        if ptm == 'global':
+            continue
+
+        #prep ptm peak arrays
+        ptm_peaks_i = ptm_peaks.take(ptm_positions.get(ptm, np.array([], dtype=int)))
+        ptm_groups = ptm_peaks_i.group_indices()
+        cluster_ptm_i = ptm_peaks_i.cluster.astype(str)
+        peak_id_ptm_i = ptm_peaks_i.peak_id.astype(str)
+
+        #get valid ptm matches per group - run evaluation function
+        ptm_counts = np.zeros(len(global_df), dtype=int)
+        match_global_index_i, match_peak_id_ptm_i = [], []
+        for code, global_index in global_groups.items():
+            ptm_index = ptm_groups.get(code)
+            if ptm_index is None:
+                continue
+            match_matrix = ptm_eval(global_group_peaks[code], ptm_peaks_i.take(ptm_index), apex_diff_cutoff=threshold)
+            ptm_counts[global_index] = match_matrix.sum(axis=1)
+
+            #collect the clusters and peak ids of the matched ptm peaks
+            global_match, ptm_match = np.where(match_matrix)
+            match_global_index.append(global_index[global_match])
+            match_cluster_ptm.append(cluster_ptm_i[ptm_index[ptm_match]])
+            match_global_index_i.append(global_index[global_match])
+            match_peak_id_ptm_i.append(peak_id_ptm_i[ptm_index[ptm_match]])
+
+        #Summarize ptm matches - counts and peak ids are kept per ptm
+        global_df[ptm] = ptm_counts
+        global_df[f'peak_id_{ptm}'] = join_ptm_matches(match_global_index_i, match_peak_id_ptm_i, len(global_df))
+
+    #the matched clusters of all ptms are joined for each global peak
+    final_global_df = global_df.assign(cluster_ptm=join_ptm_matches(match_global_index, match_cluster_ptm, len(global_df)))
+
+    #concatenated string of cluster_ptm to the cluster column
+    cluster = final_global_df['cluster'].astype(object).fillna('').astype(str)
+    cluster_ptm = final_global_df['cluster_ptm']
+    final_global_df['cluster'] = cluster.str.cat(cluster_ptm, sep=';').where((cluster != '') & (cluster_ptm != ''), cluster + cluster_ptm)
     final_global_df.drop(columns=['cluster_ptm', 'ptm'], inplace=True)
     return final_global_df
 
 
 ###Condition peak matching functions###
-def path_mean_dist(path):
-    """Calculate the mean distance of the path from the mean of the path.
-    Replace the NaNs with the threshold value.
-    
-    Args:
-        path (np.ndarray): The path to calculate the mean distance of.
-    
-    Returns:
-        np.ndarray: The squared mean distance of the path.
-    """
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore", category=RuntimeWarning)
-        path_dist = path - np.mean(path, axis=0, keepdims=True, where=~np.isnan(path)) #dtype=np.float64
-    path_dist_wThreshold = np.nan_to_num(path_dist, nan=threshold)
-    path_dist_sq = np.square(path_dist_wThreshold)
-    return path_dist_sq
-
-def path_score(path):
+@guvectorize([(float64[:], float64, float64[:])], '(k),()->()', nopython=True, cache=True)
+def path_score(path, threshold, out):
     """Calculate the score of the path based on the mean distance & variance of the path.
+    The mean distance of each path element is taken from the mean of the non-NaN values, and NaNs are replaced with the threshold value.
+    Compiled as a numba gufunc over the conditions (k) of a path - an (paths x conditions) array is scored in a single call.
     
     Args:
         path (np.ndarray): The path to calculate the score of.
+        threshold (float): The distance assigned to NaN (missing) path elements.
+        out (np.ndarray): The output array for the score of the path.
     
     Returns:
-        float: The score of the path.
+        np.ndarray: The score of each path (returned by the gufunc).
     """
-    path_dist = path_mean_dist(path) 
-    path_var = np.sum(path_dist) / len(path_dist)
-    path_score = 1 / (path_var + 1)
-    return path_score
+    #mean of the non-NaN values
+    path_sum = 0.0
+    path_count = 0
+    for value in path:
+        if not np.isnan(value):
+            path_sum += value
+            path_count += 1
+    path_mean = path_sum / path_count if path_count > 0 else np.nan
+
+    #squared mean distance, NaNs are replaced with the threshold value
+    path_dist_sq = 0.0
+    for value in path:
+        path_dist = value - path_mean
+        if np.isnan(path_dist):
+            path_dist = threshold
+        path_dist_sq += path_dist * path_dist
+
+    path_var = path_dist_sq / len(path)
+    out[0] = 1 / (path_var + 1)
 
 def fill_values(index_combinations, fill_df, fill_column='peak_apex'):
-    """Fill the values in the index_combinations array with the values from the test_df.
+    """Fill the values in the index_combinations array with the values from the fill_df.
     
     Args:
         index_combinations (np.ndarray): The array of index combinations to fill.
-        test_df (pd.DataFrame): The DataFrame containing the values to fill the index_combinations with.
+        fill_df (pd.DataFrame): The DataFrame containing the values to fill the index_combinations with.
         fill_column (str): The column to fill the index_combinations with (Default: 'peak_apex').
     
     Returns:
         np.ndarray: The filled index_combinations array with the new/replacement values."""
-    #iterate through the index_combinations array
-    index_combinations = index_combinations.copy().astype(object)
-    for i in range(index_combinations.shape[0]):
-        for j in range(index_combinations.shape[1]):
+    #map the indexes to the values of the fill_df's fill_column
+    fill_lookup = dict(zip(fill_df['index'].to_numpy(), fill_df[fill_column].to_numpy()))
 
-            #find the values corresponding to the index_combinations array from the fill_df's fill_column
-            if pd.notna(index_combinations[i, j]):
-                value = fill_df.loc[fill_df['index'] == index_combinations[i, j], fill_column].values
-                if len(value) > 0:
-                    index_combinations[i, j] = value[0]
-
-    return index_combinations
+    #find the values corresponding to the index_combinations array (NaNs and unknown indexes are kept)
+    flat_combinations = np.asarray(index_combinations, dtype=object).ravel()
+    filled_combinations = np.array([fill_lookup.get(idx, idx) if pd.notna(idx) else idx for idx in flat_combinations], dtype=object)
+    return filled_combinations.reshape(np.shape(index_combinations))
 
 def peak_alignment(peak_df): 
     """Align the peaks based on the peak apexes and return the aligned paths.
     Alignment is performed through the following steps:
     (1) Create a skeleton dataframe to ensure that all protein replicates/conditions are present in the final dataframe.
     (2) Create a list of index combinations to test the all possible peak alignments.
-    (3) Score the paths and find the top scoring path.
-    (4) Remove the peaks of the top scoring path from the peak_df and index combination iteration space.
-    (5) Repeat steps 3 and 4 until all peak alignments are found.
+    (3) Score the paths and sort them from the top scoring path down.
+    (4) Select the next path that does not contain the peaks of an already selected path.
+    (5) Repeat step 4 until only paths without peaks remain.
     
     Args:
         peak_df (pd.DataFrame): The DataFrame containing the peak data.
@@ -244,36 +325,48 @@ def peak_alignment(peak_df):
     skeleton_df[['prot_rep', 'protein_id', 'genes', 'replicate']] = peak_df[['prot_rep', 'protein_id', 'genes', 'replicate']].drop_duplicates().reset_index(drop=True)
 
     #ensures all conditions are matched
-    for c in conditions:
-        if c not in peak_df['condition'].unique():
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore", category=FutureWarning)
-                peak_df = pd.concat([peak_df, skeleton_df.copy().assign(condition=c)], ignore_index=True) #edit to ignore this warning for now
+    present_conditions = set(peak_df['condition'].unique())
+    missing_condition_dfs = [skeleton_df.assign(condition=c) for c in conditions if c not in present_conditions]
+    if missing_condition_dfs:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=FutureWarning)
+            peak_df = pd.concat([peak_df, *missing_condition_dfs], ignore_index=True) #edit to ignore this warning for now
     
-    #create a list of indexes, grouped by condition for creating combinations and add NaN to the end of each list
-    index_lists = peak_df.groupby('condition')['index'].apply(list).tolist()
-    for p in index_lists:
-        p.append(np.nan)
-
-    #create all possible index combinations
-    index_combinations = np.array(np.meshgrid(*index_lists)).T.reshape(-1, len(index_lists))
-    peak_combinations = fill_values(index_combinations, peak_df, fill_column='peak_apex').astype(float)
+    #create a list of indexes and apexes, grouped by condition for creating combinations and add NaN to the end of each list
+    peaks = PeakSOA.from_df(peak_df, peak_df['condition'].to_numpy())
+    peak_index = peak_df['index'].to_numpy(dtype=float)
+    condition_groups = peaks.group_indices(sort=True).values()
+    index_lists = [np.append(peak_index[group], np.nan) for group in condition_groups]
+    apex_lists = [np.append(peaks.apex[group], np.nan) for group in condition_groups]
+
+    #create all possible index combinations - gather each condition's indexes/apexes with the grid positions of the combinations
+    #combinations are listed in np.meshgrid(...).T order (conditions k..3, 1, 2 from slowest to fastest) - this order decides ties between equal path scores
+    grid_order = list(range(len(index_lists)))[::-1]
+    if len(grid_order) > 1:
+        grid_order[-2:] = [0, 1]
+    index_positions = np.indices([len(index_lists[i]) for i in grid_order]).reshape(len(index_lists), -1)[np.argsort(grid_order)]
+    index_combinations = np.column_stack([p[positions] for p, positions in zip(index_lists, index_positions)])
+    peak_combinations = np.column_stack([p[positions] for p, positions in zip(apex_lists, index_positions)])
+
+    #score each path once - path scores do not change as paths are removed
+    path_scores = path_score(peak_combinations, threshold)
+
+    #iterate through the paths from the top scoring path down
     result_paths = []
-
-    #iterate through the peak_combinations to find the top scoring path
-    for i in range(0, len(peak_combinations)):
-        path_scores = np.apply_along_axis(path_score, 1, peak_combinations) 
-        top_combination_index = np.where(path_scores == path_scores.max())[0][0]
-        top_combination_value = peak_combinations[top_combination_index]
+    used_indexes = set()
+    for top_combination_index in np.argsort(-path_scores, kind='stable'):
+        top_combination = index_combinations[top_combination_index]
+        top_combination_indexes = top_combination[~np.isnan(top_combination)]
 
         #if no more non-nan values stop iterating
-        if np.isnan(top_combination_value).all():
+        if len(top_combination_indexes) == 0:
             break
-        else:
-            #add the top scoring path to the result_paths and remove the path from the iteration space
-            result_paths.append(index_combinations[top_combination_index])
-            index_combinations = np.delete(index_combinations, np.where(index_combinations == index_combinations[top_combination_index])[0], axis=0)
-            peak_combinations = np.delete(peak_combinations, np.where(peak_combinations == peak_combinations[top_combination_index])[0], axis=0)
+
+        #skip paths containing peaks of a higher scoring path, otherwise add the path to the result_paths
+        if used_indexes.intersection(top_combination_indexes):
+            continue
+        result_paths.append(top_combination)
+        used_indexes.update(top_combination_indexes)
 
     return np.array(result_paths)
 
@@ -305,24 +398,74 @@ def condition_matching(peak_df, group_columns): #
 
 
 ###Organize matching functions###
-def matching_i(peak_table_i):
-    """Perform the peak matching on the input peak table.
+def _init_globals(group_columns, apex_diff_cutoff, ptm_list, condition_list):
+    """Set the global variables used by the matching functions in each worker process.
+    
+    Args:
+        group_columns (list): The list of columns to group by.
+        apex_diff_cutoff (int): The maximum difference in peak apexes allowed for a match.
+        ptm_list (np.ndarray): The ptms present in the peak table.
+        condition_list (np.ndarray): The conditions present in the peak table.
+    """
+    global group_cols, threshold, ptms, conditions
+    group_cols, threshold, ptms, conditions = group_columns, apex_diff_cutoff, ptm_list, condition_list
+
+def split_prot_rep(ptm_mod_table):
+    """Split the ptm matched peak table into a list of DataFrames, one per protein replicate.
+    
+    Args:
+        ptm_mod_table (pd.DataFrame): The DataFrame containing the ptm matched global peaks.
+    
+    Returns:
+        list: The list of DataFrames containing the peaks of each protein replicate.
+    """
+    prot_rep_codes, _ = pd.factorize(ptm_mod_table['prot_rep'].to_numpy())
+    return [group for _, group in ptm_mod_table.groupby(prot_rep_codes, sort=False)]
+
+def batch_prot_rep(prot_rep_peak_df_list, batch_size):
+    """Group the protein replicate DataFrames into batches of at least batch_size peaks (the last batch may be smaller).
+    
+    Args:
+        prot_rep_peak_df_list (list): The list of DataFrames containing the peaks of each protein replicate.
+        batch_size (int): The minimum number of peaks per batch.
+    
+    Returns:
+        list: The list of batches (lists of protein replicate DataFrames).
+    """
+    batches, batch, batch_peaks = [], [], 0
+    for peak_df in prot_rep_peak_df_list:
+        batch.append(peak_df)
+        batch_peaks += len(peak_df)
+        if batch_peaks >= batch_size:
+            batches.append(batch)
+            batch, batch_peaks = [], 0
+    if batch:
+        batches.append(batch)
+    return batches
+
+def matching_batch(peak_table_batch):
+    """Perform the condition matching on a batch of protein replicate peak tables.
     This function is to be used with the multiprocessing module.
     
     Args:
-        peak_table_i (pd.DataFrame): The DataFrame containing the peak data.
+        peak_table_batch (list): The list of DataFrames containing the ptm matched peak data of each protein replicate.
     
     Returns:
-        pd.DataFrame: The DataFrame containing the matched peaks and their attributes.
+        list: The list of DataFrames containing the matched peaks and their attributes.
     """
+    return [matching_i(peak_table_i) for peak_table_i in peak_table_batch]
 
-    input_df = peak_table_i.copy()
-    ptm_mod_table = ptm_matching(input_df)
+def matching_i(peak_table_i):
+    """Perform the condition matching on the ptm matched peak table of a protein replicate.
     
-    if ptm_mod_table is None:
-        return None
-    else:
-        return condition_matching(ptm_mod_table.reset_index(drop=True).reset_index(), group_cols)
+    Args:
+        peak_table_i (pd.DataFrame): The DataFrame containing the ptm matched peak data.
+    
+    Returns:
+        pd.DataFrame: The DataFrame containing the matched peaks and their attributes.
+    """
+
+    return condition_matching(peak_table_i.reset_index(drop=True).reset_index(), group_cols)
 
 
 #reorganize script to run with click
@@ -339,25 +482,31 @@ def main(sql_db, cutoff, peak_table_name, align_table_name):
     #import the peak_table and define global variables
     click.echo('Importing peak table and defining global variables...')
     manager = SQLitePeakMatchingManager(sql_db, peak_table_name)
-    prot_rep_peak_df_list = manager.prot_rep_peak_df_list.copy()
 
     global peak_table, prot_rep, group_cols, conditions, ptms, threshold
-    peak_table, prot_rep, group_cols, conditions, ptms, threshold = manager.peak_table.copy(), manager.prot_rep.copy(), manager.group_cols.copy(), manager.conditions.copy(), manager.ptms.copy(), cutoff
-    manager.close_connection()
+    peak_table, prot_rep, group_cols, conditions, ptms, threshold = manager.peak_table, manager.prot_rep, manager.group_cols, manager.conditions, manager.ptms, cutoff
 
-    #perform peak matching and alignment
+    #perform ptm peak matching on the full peak table in a single pass
+    click.echo('Performing ptm peak matching...')
+    ptm_mod_table = ptm_matching(peak_table)
+    prot_rep_peak_df_list = split_prot_rep(ptm_mod_table)
+
+    #perform condition peak matching and alignment
     click.echo('Performing peak matching and alignment...')
-    mapped_result = map(matching_i, prot_rep_peak_df_list)
-    clustered_global_intensity_table = pd.concat(mapped_result, ignore_index=True).reset_index(drop=True)
+    #protein replicates are batched by peak count (about 4 batches per worker) so that small replicates share a task
+    prot_rep_batches = batch_prot_rep(prot_rep_peak_df_list, max(1, len(ptm_mod_table) // (4 * os.cpu_count())))
+    with multiprocessing.Pool(processes=os.cpu_count(), initializer=_init_globals, initargs=(group_cols, threshold, ptms, conditions)) as pool:
+        mapped_result = [result for batch_result in pool.imap_unordered(matching_batch, prot_rep_batches) for result in batch_result]
+    clustered_global_intensity_table = pd.concat(mapped_result, ignore_index=True, copy=False)
 
-    #move all columns with 'peak' to the end using regex, and drop a few columns
+    #drop a few columns, and move all columns with 'peak' to the end using regex
     click.echo('Reorganizing columns...')
-    clustered_global_intensity_table = clustered_global_intensity_table[clustered_global_intensity_table.columns.drop(list(clustered_global_intensity_table.filter(regex='peak'))).tolist() + clustered_global_intensity_table.filter(regex='peak').columns.tolist()]
-    clustered_global_intensity_table = clustered_global_intensity_table.drop(columns=['index', 'prot_rep'], axis=1).reset_index(drop=True)
+    clustered_global_intensity_table.drop(columns=['index', 'prot_rep'], inplace=True)
+    peak_columns = clustered_global_intensity_table.filter(regex='peak').columns
+    clustered_global_intensity_table = clustered_global_intensity_table.reindex(columns=clustered_global_intensity_table.columns.drop(peak_columns).tolist() + peak_columns.tolist(), copy=False)
     
     #save results to SQLite database
     click.echo('Saving results to SQLite database...')
-    manager = SQLitePeakMatchingManager(sql_db, peak_table_name)
     manager.save_to_SQL(clustered_global_intensity_table, align_table_name)
     manager.close_connection()
 
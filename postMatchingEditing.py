@@ -226,7 +226,7 @@ class matchTableEditor:
                 log2fx (float): The log2 fold change of the PTM peaks."""
 
             #get peak id lists
-            peak_id_ptm = row['peak_id_ptm']
+            peak_id_ptm = row['peak_id_phospho']
             peak_id_ptm_a = peak_id_ptm[0]
             peak_id_ptm_b = peak_id_ptm[1]
 